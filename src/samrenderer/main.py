@@ -1,12 +1,16 @@
 import yaml
 import boto3
+import os
 import re
 import sys
 import argparse
+import copy
 import difflib
 import json
-import asyncio
 import subprocess
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError, BotoCoreError
 
 try:
@@ -14,6 +18,12 @@ try:
 except ImportError:  # pragma: no cover
     import tomli as toml  # pip install tomli
 
+try:
+    from yaml import CSafeDumper as _YAMLDumper, CSafeLoader as _YAMLLoader  # libyaml
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as _YAMLDumper, SafeLoader as _YAMLLoader
+
+
 # Constants for log levels
 LOG_LEVELS = {
     "DEBUG": 10,
@@ -24,14 +34,44 @@ LOG_LEVELS = {
     "CRITICAL": 50,
 }
 
+# ANSI colors for diff output, keyed by unified diff line prefix
+RED = "\033[31m"
+GREEN = "\033[32m"
+CYAN = "\033[36m"
+RESET = "\033[0m"
+DIFF_COLORS = {"-": RED, "+": GREEN, "@": CYAN}
+
+# Pre-compiled patterns used on the hot resolution path
+_SUB_RE = re.compile(r"\${([^!][^}]*)}")
+_DYNREF_RE = re.compile(r"\{\{resolve:([^:]+):([^}]+)\}\}")
+_OVERRIDE_RE = re.compile(r"([a-zA-Z0-9\-_]+)=(?:\"([^\"]*)\"|([^\s\"]+))")
+
+# Length of the shortest possible dynamic reference, "{{resolve:x:y}}"
+_MIN_DYNREF_LEN = 15
+
+# Maximum number of ids accepted by a single BatchGetSecretValue call
+_SECRETS_BATCH_SIZE = 20
+
+# Upper bound on concurrent AWS calls made while prefetching
+_PREFETCH_WORKERS = 8
+
+# Leaf types returned by resolve() unchanged
+_SCALAR_TYPES = frozenset({bool, int, float, type(None)})
+
+# Marks a cache miss where None/False are legitimate cached values
+_SENTINEL = object()
+
 
 # --- 1. YAML Tag Handling ---
-class CFNLoader(yaml.SafeLoader):
+class CFNLoader(_YAMLLoader):
     pass
 
 
 def multi_constructor(loader, tag_suffix, node):
+    # Interned keys make the intrinsic dispatch lookup an identity match;
+    # _TAG_KEYS is built from the handler table further down
     tag = tag_suffix
+    key = _TAG_KEYS.get(tag) or sys.intern(f"Fn::{tag}")
 
     if tag == "GetAtt":
         val = (
@@ -39,15 +79,18 @@ def multi_constructor(loader, tag_suffix, node):
             if isinstance(node, yaml.SequenceNode)
             else loader.construct_scalar(node).split(".")
         )
-        return {"Fn::GetAtt": val}
+        return {key: val}
     elif isinstance(node, yaml.ScalarNode):
         val = loader.construct_scalar(node)
-        key = "Ref" if tag == "Ref" else f"Fn::{tag}"
+        if tag == "Ref":
+            return {"Ref": sys.intern(val)}
+        if tag == "Condition":
+            val = sys.intern(val)
         return {key: val}
     elif isinstance(node, yaml.SequenceNode):
-        return {f"Fn::{tag}": loader.construct_sequence(node)}
+        return {key: loader.construct_sequence(node)}
     elif isinstance(node, yaml.MappingNode):
-        return {f"Fn::{tag}": loader.construct_mapping(node)}
+        return {key: loader.construct_mapping(node)}
 
     return None
 
@@ -55,32 +98,61 @@ def multi_constructor(loader, tag_suffix, node):
 CFNLoader.add_multi_constructor("!", multi_constructor)
 
 
+def _intern_keys(mapping):
+    """Copy of mapping with its string keys interned."""
+    return {sys.intern(k) if type(k) is str else k: v for k, v in mapping.items()}
+
+
+@functools.lru_cache(maxsize=16)
+def _load_template(template_path, mtime_ns):
+    # Keyed on mtime so an edited file is parsed again. The cached tree is
+    # never handed out directly; each renderer deep-copies it.
+    # Binary mode lets the loader detect and decode the encoding itself
+    with open(template_path, "rb") as f:
+        return yaml.load(f, Loader=CFNLoader)
+
+
 # --- 2. SAM Config Parsing ---
 def parse_sam_overrides(override_string):
     if not override_string:
         return {}
 
-    pattern = re.compile(r"([a-zA-Z0-9\-_]+)=(?:\"([^\"]*)\"|([^\s\"]+))")
+    # Group 2 is a quoted value (possibly empty), group 3 a bare one
+    return {
+        m.group(1): m.group(2) if m.group(2) is not None else m.group(3)
+        for m in _OVERRIDE_RE.finditer(override_string)
+    }
 
-    matches = pattern.findall(override_string)
 
-    return {m[0]: m[1] or m[2] for m in matches}
+@functools.lru_cache(maxsize=32)
+def _read_sam_config(config_path, mtime_ns):
+    # Keyed on mtime so an edited file is parsed again; callers must not
+    # mutate the returned document
+    with open(config_path, "rb") as f:
+        return toml.load(f)
 
 
-def load_sam_config(config_path, environment="default"):
-    try:
-        with open(config_path, "rb") as f:
-            data = toml.load(f)
+def _sam_config_values(data, environment):
+    params = data.get(environment, {}).get("deploy", {}).get("parameters", {})
+    overrides_str = params.get("parameter_overrides", "")
+
+    config_values = parse_sam_overrides(overrides_str)
+
+    if "region" in params:
+        config_values["AWS::Region"] = params["region"]
 
-        params = data.get(environment, {}).get("deploy", {}).get("parameters", {})
-        overrides_str = params.get("parameter_overrides", "")
+    return config_values
 
-        config_values = parse_sam_overrides(overrides_str)
 
-        if "region" in params:
-            config_values["AWS::Region"] = params["region"]
+def _parse_sam_config(text, environment="default"):
+    # Raises on malformed TOML; load_sam_config turns that into a warning
+    return _sam_config_values(toml.loads(text), environment)
 
-        return config_values
+
+def load_sam_config(config_path, environment="default"):
+    try:
+        data = _read_sam_config(config_path, os.stat(config_path).st_mtime_ns)
+        return _sam_config_values(data, environment)
 
     except FileNotFoundError:
         print(f"Warning: SAM Config file '{config_path}' not found.", file=sys.stderr)
@@ -120,33 +192,96 @@ def ensure_sso_login(profile):
             # We don't exit here; we let the renderer fail naturally later if it needs creds
 
 
+@functools.lru_cache(maxsize=8)
+def _get_session(profile, region):
+    """Return the boto3 Session shared by renderers with this profile/region."""
+    return boto3.Session(profile_name=profile, region_name=region)
+
+
+# Sessions are not thread-safe, and the --env2 renders may share one
+_SESSION_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=32)
+def _mock_azs(region):
+    """Mock availability zone names for a region."""
+    return (f"{region}a", f"{region}b", f"{region}c")
+
+
 # --- 4. Resolution Logic ---
 class TemplateRenderer:
+    """Resolves a template's intrinsic functions against a parameter context.
+
+    Condition results are memoized per renderer, so change parameter values
+    through update_context() rather than by editing ``context`` directly.
+    """
+
+    # Fixed attribute layout: no per-instance __dict__ on the resolve hot path
+    __slots__ = (
+        "t",
+        "mappings",
+        "transform",
+        "awstempver",
+        "conditions",
+        "resources",
+        "env_name",
+        "profile",
+        "log_level_int",
+        "_debug_enabled",
+        "current_resource_id",
+        "current_resource_type",
+        "context",
+        "boto_session",
+        "_cfn",
+        "_sm",
+        "_resource_mocks",
+        "_secret_cache",
+        "_exports_map",
+        "_cond_cache",
+        "_operand_cache",
+    )
+
     def __init__(
         self,
-        template_path,
+        template_path=None,
         profile=None,
         region="us-east-1",
         env_name="default",
         log_level="WARN",
+        template_dict=None,
     ):
-        with open(template_path, "r") as f:
-            self.t = yaml.load(f, Loader=CFNLoader)
+        # An already parsed template (as loaded with CFNLoader) skips the file
+        # read; the renderer takes ownership of it rather than copying it.
+        if template_dict is not None:
+            self.t = template_dict
+        elif template_path is not None:
+            mtime_ns = os.stat(template_path).st_mtime_ns
+            # A copy is still far cheaper than a parse, and keeps edits to
+            # one renderer's tree out of every later renderer of the file
+            self.t = copy.deepcopy(_load_template(template_path, mtime_ns))
+        else:
+            raise ValueError("Either template_path or template_dict is required")
 
         self.mappings = self.t.get("Mappings", {})
         self.transform = self.t.get("Transform", [])
         self.awstempver = self.t.get("AWSTemplateFormatVersion", "")
-        self.conditions = self.t.get("Conditions", {})
-        self.resources = self.t.get("Resources", {})
+        # Names are interned to match the interned Ref/Condition operands
+        self.conditions = _intern_keys(self.t.get("Conditions") or {})
+        self.resources = _intern_keys(self.t.get("Resources") or {})
+        self._resource_mocks = {
+            logical_id: f"mock-{logical_id.lower()}-id" for logical_id in self.resources
+        }
         self.env_name = env_name
         self.profile = profile
         self.log_level_int = LOG_LEVELS.get(log_level.upper(), 30)
+        # Lets hot paths skip building DEBUG messages that would be dropped
+        self._debug_enabled = self.log_level_int <= LOG_LEVELS["DEBUG"]
 
         # Track current resource context for logging
         self.current_resource_id = None
         self.current_resource_type = None
 
-        self.context = {
+        context = {
             "AWS::Region": region,
             "AWS::AccountId": "123456789012",
             "AWS::StackName": "Local-Render-Stack",
@@ -157,20 +292,29 @@ class TemplateRenderer:
 
         for name, p in self.t.get("Parameters", {}).items():
             if "Default" in p:
-                self.context[name] = p["Default"]
+                context[name] = p["Default"]
 
-        # Initialize clients directly (assumes login handled externally)
-        self.boto_session = (
-            boto3.Session(profile_name=self.profile, region_name=region)
-            if self.profile
-            else None
-        )
-        self.cfn_client = (
-            self.boto_session.client("cloudformation") if self.boto_session else None
-        )
-        self.sm_client = (
-            self.boto_session.client("secretsmanager") if self.boto_session else None
-        )
+        self.context = _intern_keys(context)
+
+        # Clients are created on first use (assumes login handled externally)
+        self.boto_session = _get_session(self.profile, region) if self.profile else None
+        self._cfn = None
+        self._sm = None
+
+        # AWS lookups are cached for the lifetime of the renderer
+        self._secret_cache = {}
+        self._exports_map = None
+
+        # Memoized Condition results, keyed by condition name
+        self._clear_caches()
+        # And/Or sub-expression results, keyed by node identity; only set
+        # while a top-level resolve() walk is running
+        self._operand_cache = None
+
+    @classmethod
+    def from_string(cls, yaml_text, **kwargs):
+        """Build a renderer from template source text instead of a file."""
+        return cls(template_dict=yaml.load(yaml_text, Loader=CFNLoader), **kwargs)
 
     def _log(self, operation, key, message=None, level="INFO"):
         msg_level_int = LOG_LEVELS.get(level.upper(), 20)
@@ -192,16 +336,70 @@ class TemplateRenderer:
 
         if message:
             entry["message"] = message
-        print(json.dumps(entry), file=sys.stderr)
+        # One write per entry so lines from concurrent renders never interleave
+        sys.stderr.write(json.dumps(entry) + "\n")
+
+    @property
+    def cfn_client(self):
+        if self._cfn is None and self.boto_session:
+            with _SESSION_LOCK:
+                if self._cfn is None:
+                    self._cfn = self.boto_session.client("cloudformation")
+        return self._cfn
+
+    @property
+    def sm_client(self):
+        if self._sm is None and self.boto_session:
+            with _SESSION_LOCK:
+                if self._sm is None:
+                    self._sm = self.boto_session.client("secretsmanager")
+        return self._sm
+
+    def update_context(self, values):
+        """Override parameter values, discarding results that depended on them."""
+        self.context.update(_intern_keys(values))
+        self._clear_caches()
+
+    def _clear_caches(self):
+        # Condition results are only valid for the context they saw
+        self._cond_cache = {}
+
+    def resolve_conditions(self):
+        """Evaluate the Conditions block, reusing memoized results."""
+        resolved = {}
+        for name in self.conditions:
+            result = self._handle_condition(name)
+            # Filter out AWS::NoValue (None), as resolve() would
+            if result is not None:
+                resolved[name] = result
+        return resolved
 
     def resolve_resources(self):
         """Special resolver for the Resources block to track context."""
+        # The context may have been edited directly since the last pass
+        self._clear_caches()
+        # Every Condition is evaluated once up front; Fn::If and Condition
+        # keys in the resources are then cache hits
+        self.resolve_conditions()
+
         resolved = {}
         for logical_id, res_def in self.resources.items():
             self.current_resource_id = logical_id
-            self.current_resource_type = (
-                res_def.get("Type") if isinstance(res_def, dict) else None
-            )
+            is_dict = isinstance(res_def, dict)
+            self.current_resource_type = res_def.get("Type") if is_dict else None
+
+            # Like CloudFormation, leave out resources whose Condition is false
+            condition = res_def.get("Condition") if is_dict else None
+            if type(condition) is str:
+                if condition not in self.conditions:
+                    # CloudFormation rejects the template; keep the resource
+                    # so the mistake stays visible in the output
+                    self._log(
+                        "Condition", condition, "Undefined condition", level="ERROR"
+                    )
+                elif not self._handle_condition(condition):
+                    self._log("Condition", condition, "Resource skipped", level="INFO")
+                    continue
 
             # Resolve the resource definition
             resolved_val = self.resolve(res_def)
@@ -215,68 +413,89 @@ class TemplateRenderer:
         return resolved
 
     def resolve(self, node):
-        if isinstance(node, dict):
-            if len(node) == 1:
-                key = list(node.keys())[0]
-                val = node[key]
-
-                # Core
-                if key == "Ref":
-                    return self._handle_ref(val)
-                if key == "Fn::FindInMap":
-                    return self._handle_map(val)
-                if key == "Fn::Sub":
-                    return self._handle_sub(val)
-                if key == "Fn::ImportValue":
-                    return self._handle_import(val)
-                if key == "Fn::Join":
-                    return self._handle_join(val)
-                if key == "Fn::GetAtt":
-                    return self._handle_getatt(val)
-                if key == "Fn::Select":
-                    return self._handle_select(val)
-                if key == "Fn::Split":
-                    return self._handle_split(val)
-                if key == "Fn::Base64":
-                    return self._handle_base64(val)
-                if key == "Fn::GetAZs":
-                    return self._handle_getazs(val)
-                if key == "Fn::Length":
-                    return self._handle_length(val)
-
-                # Logic
-                if key == "Fn::If":
-                    return self._handle_if(val)
-                if key == "Fn::Equals":
-                    return self._handle_equals(val)
-                if key == "Fn::Not":
-                    return self._handle_not(val)
-                if key == "Fn::And":
-                    return self._handle_and(val)
-                if key == "Fn::Or":
-                    return self._handle_or(val)
-                if key == "Condition":
-                    return self._handle_condition(val)
-                if key == "Fn::Condition":
-                    return self._handle_condition(val)
-
-            # Filter out AWS::NoValue (None) from dictionaries
-            resolved_dict = {}
-            for k, v in node.items():
-                resolved_v = self.resolve(v)
-                if resolved_v is not None:
-                    resolved_dict[k] = resolved_v
-            return resolved_dict
-
-        elif isinstance(node, list):
-            # Filter out AWS::NoValue (None) from lists
-            return [r for x in node if (r := self.resolve(x)) is not None]
-
-        elif isinstance(node, str):
-            # Check for CloudFormation dynamic references
-            return self._resolve_dynamic_reference(node)
-
-        return node
+        # Leaves skip the stack set-up below; handlers resolve many scalar
+        # arguments such as Ref names and Fn::Equals operands
+        t = type(node)
+        if t is str:
+            if "{{resolve:" in node:
+                return self._resolve_dynamic_reference(node)
+            return node
+        if t in _SCALAR_TYPES:
+            return node
+
+        if self._operand_cache is not None:
+            return self._walk(node)
+        # Outermost call: shared And/Or operands are deduplicated within this
+        # walk only, so later calls see the current context and nodes
+        self._operand_cache = {}
+        try:
+            return self._walk(node)
+        finally:
+            self._operand_cache = None
+
+    def _walk(self, node):
+        # Iterative post-order walk: a container is pushed once to schedule its
+        # children and again, tagged with its type, to assemble its resolved
+        # copy from their results.
+        stack = [(node, None)]
+        results = []
+        while stack:
+            item, built = stack.pop()
+
+            if built is not None:
+                start = len(results) - len(item)
+                children = results[start:]
+                del results[start:]
+                if built is dict:
+                    # Filter out AWS::NoValue (None) from dictionaries
+                    results.append(
+                        {k: v for k, v in zip(item, children) if v is not None}
+                    )
+                else:
+                    # Filter out AWS::NoValue (None) from lists
+                    results.append([v for v in children if v is not None])
+                continue
+
+            # Exact type checks; the loader only produces builtin types
+            t = type(item)
+            if t is str:
+                # Check for CloudFormation dynamic references; the inline test
+                # spares plain strings the method call
+                results.append(
+                    self._resolve_dynamic_reference(item)
+                    if "{{resolve:" in item
+                    else item
+                )
+
+            elif t is dict:
+                if len(item) == 1:
+                    ((key, val),) = item.items()
+                    handler = _INTRINSIC_HANDLERS.get(key)
+                    if handler is not None:
+                        results.append(handler(self, val))
+                        continue
+                stack.append((item, dict))
+                stack.extend((v, None) for v in reversed(item.values()))
+
+            elif t is list:
+                stack.append((item, list))
+                stack.extend((v, None) for v in reversed(item))
+
+            elif t in _SCALAR_TYPES:
+                results.append(item)
+
+            # Subclasses of the builtin types are revisited as their base type
+            elif isinstance(item, dict):
+                stack.append((dict(item), None))
+            elif isinstance(item, list):
+                stack.append((list(item), None))
+            elif isinstance(item, str):
+                stack.append((str(item), None))
+
+            else:
+                results.append(item)
+
+        return results[0]
 
     # --- Intrinsic Handlers ---
 
@@ -287,16 +506,27 @@ class TemplateRenderer:
                 return self._resolve_dynamic_reference(result)
             return result
         if ref_key in self.resources:
-            return f"mock-{ref_key.lower()}-id"
+            return self._resource_mock_id(ref_key)
         return f"{{Ref: {ref_key}}}"
 
+    def _resource_mock_id(self, logical_id):
+        mock_id = self._resource_mocks.get(logical_id)
+        if mock_id is None:
+            # Resources added after __init__ get their mock id on first use
+            mock_id = self._resource_mocks[logical_id] = f"mock-{logical_id.lower()}-id"
+        return mock_id
+
     def _resolve_dynamic_reference(self, text):
         """Resolve CloudFormation dynamic references like {{resolve:secretsmanager:...}}"""
         if not isinstance(text, str):
             return text
 
-        pattern = r"\{\{resolve:([^:]+):([^}]+)\}\}"
-        match = re.search(pattern, text)
+        # Most strings hold no reference; a length check and substring test
+        # are far cheaper than the regex
+        if len(text) < _MIN_DYNREF_LEN or "{{resolve:" not in text:
+            return text
+
+        match = _DYNREF_RE.search(text)
 
         if not match:
             return text
@@ -315,10 +545,13 @@ class TemplateRenderer:
         secret_id = parts[0]
         json_key = parts[1] if len(parts) > 1 else None
 
-        if self.boto_session:
+        if self.sm_client:
             try:
-                sm_client = self.boto_session.client("secretsmanager")
-                response = sm_client.get_secret_value(SecretId=secret_id)
+                # Different JSON keys of one secret share a single fetch
+                response = self._secret_cache.get(secret_id)
+                if response is None:
+                    response = self.sm_client.get_secret_value(SecretId=secret_id)
+                    self._secret_cache[secret_id] = response
 
                 if "SecretBinary" in response:
                     self._log("Resolve:SecretsManager", reference, level="INFO")
@@ -328,8 +561,6 @@ class TemplateRenderer:
 
                 if json_key:
                     try:
-                        import json
-
                         secret_data = json.loads(secret_string)
                         if json_key not in secret_data:
                             self._log(
@@ -359,6 +590,87 @@ class TemplateRenderer:
 
         return f"mock-secret-{secret_id}"
 
+    def _collect_refs(self, node):
+        """Find the AWS lookups node needs: secret ids and whether it imports values."""
+        secret_ids = set()
+        has_imports = False
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, dict):
+                has_imports = has_imports or "Fn::ImportValue" in item
+                stack.extend(item.values())
+            elif isinstance(item, list):
+                stack.extend(item)
+            elif isinstance(item, str) and "{{resolve:" in item:
+                for service, reference in _DYNREF_RE.findall(item):
+                    if service == "secretsmanager":
+                        secret_ids.add(reference.split(":")[0])
+        return secret_ids, has_imports
+
+    def prefetch(self):
+        """
+        Warm the secret and export caches before resolution. Secrets are fetched
+        in BatchGetSecretValue batches that run concurrently with list_exports.
+        """
+        secret_ids, has_imports = self._collect_refs(
+            [self.resources, self.mappings, list(self.context.values())]
+        )
+
+        # Clients are created here, on this thread, before any worker uses them
+        batches = []
+        if secret_ids and self.sm_client:
+            pending = sorted(sid for sid in secret_ids if sid not in self._secret_cache)
+            batches = [
+                pending[i : i + _SECRETS_BATCH_SIZE]
+                for i in range(0, len(pending), _SECRETS_BATCH_SIZE)
+            ]
+        fetch_exports = (
+            has_imports and self.cfn_client is not None and self._exports_map is None
+        )
+
+        jobs = len(batches) + fetch_exports
+        if not jobs:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(jobs, _PREFETCH_WORKERS)) as executor:
+            exports_future = (
+                executor.submit(self._get_exports) if fetch_exports else None
+            )
+            batch_futures = [
+                (
+                    batch,
+                    executor.submit(
+                        self.sm_client.batch_get_secret_value, SecretIdList=batch
+                    ),
+                )
+                for batch in batches
+            ]
+
+            # Failures are only warnings; misses fall back to lookups at resolve time
+            for batch, future in batch_futures:
+                try:
+                    response = future.result()
+                except (ClientError, BotoCoreError) as e:
+                    self._log(
+                        "Prefetch:SecretsManager", ",".join(batch), str(e), level="WARN"
+                    )
+                    continue
+
+                # References may use either the secret name or its ARN
+                for secret in response.get("SecretValues", []):
+                    for key in (secret.get("Name"), secret.get("ARN")):
+                        if key:
+                            self._secret_cache[key] = secret
+
+            if exports_future is not None:
+                try:
+                    exports_future.result()
+                except (ClientError, BotoCoreError) as e:
+                    self._log(
+                        "Prefetch:ImportValue", "list_exports", str(e), level="WARN"
+                    )
+
     def _handle_map(self, args):
         m_name = self.resolve(args[0])
         top = self.resolve(args[1])
@@ -385,33 +697,52 @@ class TemplateRenderer:
         text = args[0] if isinstance(args, list) else args
         vars_map = args[1] if isinstance(args, list) else {}
 
+        # Each variable is resolved on its first ${...} match and reused for
+        # later ones; unused entries of the variable map are never resolved
+        lookup = {}
+
         def repl(match):
-            var = match.group(1)
+            val = self._lookup_sub_var(match.group(1), vars_map, lookup)
+            # Unknown variables are left in place, e.g. "${Unknown}"
+            return match.group(0) if val is None else val
+
+        return _SUB_RE.sub(repl, text)
+
+    def _lookup_sub_var(self, var, vars_map, lookup):
+        """Look up a Fn::Sub variable: locals, then context, then resources."""
+        hit = lookup.get(var)
+        if hit is None:
             if var in vars_map:
-                val = str(self.resolve(vars_map[var]))
-                self._log("Sub", var, f"Resolved to: {val}", level="DEBUG")
-                return val
-            if var in self.context:
-                val = str(self.resolve(self.context[var]))
-                self._log("Sub", var, f"Resolved to: {val}", level="DEBUG")
-                return val
-            if var in self.resources:
-                val = f"mock-{var.lower()}-id"
-                self._log("Sub", var, f"Resolved to Mock: {val}", level="DEBUG")
-                return val
-            return match.group(0)
-
-        return re.sub(r"\${([^!][^}]*)}", repl, text)
+                hit = (str(self.resolve(vars_map[var])), "Resolved to")
+            elif var in self.context:
+                hit = (str(self.resolve(self.context[var])), "Resolved to")
+            elif var in self.resources:
+                hit = (self._resource_mock_id(var), "Resolved to Mock")
+            else:
+                return None
+            lookup[var] = hit
+        val, label = hit
+        if self._debug_enabled:
+            self._log("Sub", var, f"{label}: {val}", level="DEBUG")
+        return val
+
+    def _get_exports(self):
+        """Return the account's exports as a name -> value dict, fetched once."""
+        if self._exports_map is None:
+            pages = self.cfn_client.get_paginator("list_exports").paginate()
+            self._exports_map = {
+                exp["Name"]: exp["Value"] for page in pages for exp in page["Exports"]
+            }
+        return self._exports_map
 
     def _handle_import(self, val):
         import_name = self.resolve(val)
         if self.cfn_client:
             try:
-                exports = self.cfn_client.list_exports()
-                for exp in exports["Exports"]:
-                    if exp["Name"] == import_name:
-                        self._log("ImportValue", import_name, level="INFO")
-                        return exp["Value"]
+                exports = self._get_exports()
+                if import_name in exports:
+                    self._log("ImportValue", import_name, level="INFO")
+                    return exports[import_name]
             except (ClientError, BotoCoreError) as e:
                 self._log("ImportValue", import_name, str(e), level="ERROR")
                 pass
@@ -455,7 +786,8 @@ class TemplateRenderer:
         region = self.resolve(val)
         if not region:
             region = self.context["AWS::Region"]
-        return [f"{region}a", f"{region}b", f"{region}c"]
+        # A fresh list per call; shared objects would be dumped as YAML aliases
+        return list(_mock_azs(region))
 
     # --- Logic Handlers ---
     def _handle_equals(self, args):
@@ -466,30 +798,89 @@ class TemplateRenderer:
         return not self.resolve(condition)
 
     def _handle_and(self, args):
-        return all(self.resolve(arg) for arg in args)
+        for arg in args:
+            if not self._resolve_operand(arg):
+                return False
+        return True
 
     def _handle_or(self, args):
-        return any(self.resolve(arg) for arg in args)
+        for arg in args:
+            if self._resolve_operand(arg):
+                return True
+        return False
+
+    def _resolve_operand(self, arg):
+        """Resolve an And/Or operand, reusing results for shared sub-expressions."""
+        if not isinstance(arg, dict):
+            return self.resolve(arg)
+
+        # The node itself is stored alongside the result so its id stays unique
+        cached = self._operand_cache.get(id(arg))
+        if cached is None:
+            cached = self._operand_cache[id(arg)] = (arg, self.resolve(arg))
+        return cached[1]
 
     def _handle_condition(self, name):
-        if name in self.conditions:
-            return self.resolve(self.conditions[name])
-        return False
+        # Conditions only depend on the context, so each is evaluated once
+        result = self._cond_cache.get(name, _SENTINEL)
+        if result is _SENTINEL:
+            result = (
+                self.resolve(self.conditions[name])
+                if name in self.conditions
+                else False
+            )
+            self._cond_cache[name] = result
+        return result
 
     def _handle_if(self, args):
         condition_name = args[0]
         value_if_true = args[1]
         value_if_false = args[2]
 
-        is_true = False
-        if condition_name in self.conditions:
-            is_true = self.resolve(self.conditions[condition_name])
-
+        is_true = self._handle_condition(condition_name)
         result_node = value_if_true if is_true else value_if_false
         return self.resolve(result_node)
 
 
+# Intrinsic function handlers, keyed by their interned long-form name. Built
+# once for the class and called unbound.
+_INTRINSIC_HANDLERS = {
+    sys.intern(name): handler
+    for name, handler in {
+        # Core
+        "Ref": TemplateRenderer._handle_ref,
+        "Fn::FindInMap": TemplateRenderer._handle_map,
+        "Fn::Sub": TemplateRenderer._handle_sub,
+        "Fn::ImportValue": TemplateRenderer._handle_import,
+        "Fn::Join": TemplateRenderer._handle_join,
+        "Fn::GetAtt": TemplateRenderer._handle_getatt,
+        "Fn::Select": TemplateRenderer._handle_select,
+        "Fn::Split": TemplateRenderer._handle_split,
+        "Fn::Base64": TemplateRenderer._handle_base64,
+        "Fn::GetAZs": TemplateRenderer._handle_getazs,
+        "Fn::Length": TemplateRenderer._handle_length,
+        # Logic
+        "Fn::If": TemplateRenderer._handle_if,
+        "Fn::Equals": TemplateRenderer._handle_equals,
+        "Fn::Not": TemplateRenderer._handle_not,
+        "Fn::And": TemplateRenderer._handle_and,
+        "Fn::Or": TemplateRenderer._handle_or,
+        "Condition": TemplateRenderer._handle_condition,
+        "Fn::Condition": TemplateRenderer._handle_condition,
+    }.items()
+}
+
+# The loader emits these same key objects, so the dispatch lookup in
+# resolve() is an identity match
+_INTRINSIC_KEYS = tuple(_INTRINSIC_HANDLERS)
+
+# Short-form tag suffix (e.g. "Sub" for !Sub) to its interned long-form key
+_TAG_KEYS = {k[4:]: k for k in _INTRINSIC_KEYS if k.startswith("Fn::")}
+
+
 # --- Processing Logic ---
+
+
 def process(config, env, template, profile, log_level="WARN"):
     sam_params = load_sam_config(config, env)
     region = sam_params.get("AWS::Region", "us-east-1")
@@ -497,7 +888,10 @@ def process(config, env, template, profile, log_level="WARN"):
     renderer = TemplateRenderer(
         template, profile=profile, region=region, env_name=env, log_level=log_level
     )
-    renderer.context.update(sam_params)
+    renderer.update_context(sam_params)
+
+    # Fetch every referenced secret and export up front, concurrently
+    renderer.prefetch()
 
     # Use resolve_resources to track Logical ID context
     resolved_resources = renderer.resolve_resources()
@@ -506,14 +900,22 @@ def process(config, env, template, profile, log_level="WARN"):
         "AWSTemplateFormatVersion": renderer.awstempver,
         "Transform": renderer.transform,
         "Resources": resolved_resources,
-        "Conditions": renderer.resolve(renderer.conditions),
+        "Conditions": renderer.resolve_conditions(),
     }
     return output
 
 
+# Shared settings for the YAML documents compared in a diff
+_DIFF_DUMP_KWARGS = {
+    "Dumper": _YAMLDumper,
+    "sort_keys": True,
+    "default_flow_style": False,
+}
+
+
 def compare(a, b):
-    a_lines = yaml.dump(a[1], sort_keys=True).splitlines()
-    b_lines = yaml.dump(b[1], sort_keys=True).splitlines()
+    a_lines = yaml.dump(a[1], **_DIFF_DUMP_KWARGS).splitlines()
+    b_lines = yaml.dump(b[1], **_DIFF_DUMP_KWARGS).splitlines()
 
     diff = difflib.unified_diff(
         a_lines,
@@ -523,28 +925,17 @@ def compare(a, b):
         lineterm="",
     )
 
-    RED = "\033[31m"
-    GREEN = "\033[32m"
-    CYAN = "\033[36m"
-    RESET = "\033[0m"
-
     colored_output = []
     for line in diff:
-        if line.startswith("---") or line.startswith("+++"):
-            colored_output.append(f"{CYAN}{line}{RESET}")
-        elif line.startswith("-"):
-            colored_output.append(f"{RED}{line}{RESET}")
-        elif line.startswith("+"):
-            colored_output.append(f"{GREEN}{line}{RESET}")
-        elif line.startswith("@@"):
-            colored_output.append(f"{CYAN}{line}{RESET}")
-        else:
-            colored_output.append(line)
+        # File headers share their first character with removed/added lines
+        color = CYAN if line[:3] in ("---", "+++") else DIFF_COLORS.get(line[:1])
+        colored_output.append(f"{color}{line}{RESET}" if color else line)
 
     return "\n".join(colored_output)
 
 
-async def async_main():
+def render_cli(argv=None):
+    """Run the CLI for argv (default: sys.argv[1:]) and return its output text."""
     parser = argparse.ArgumentParser(
         description="Render CloudFormation/SAM templates.",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -585,7 +976,7 @@ async def async_main():
         choices=["DEBUG", "INFO", "WARN", "WARNING", "ERROR"],
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Determine profiles for both envs
     prof1 = args.profile
@@ -597,31 +988,32 @@ async def async_main():
         ensure_sso_login(p)
 
     if args.env2 is not None:
-        # Run both process calls in parallel threads
-        task1 = asyncio.to_thread(
-            process, args.config, args.env, args.template, prof1, args.log_level
-        )
-        task2 = asyncio.to_thread(
-            process, args.config, args.env2, args.template, prof2, args.log_level
-        )
-
-        output1, output2 = await asyncio.gather(task1, task2)
-
-        diff = compare([args.env, output1], [args.env2, output2])
-        print(diff)
-    else:
-        output = await asyncio.to_thread(
-            process, args.config, args.env, args.template, prof1, args.log_level
-        )
-        print(
-            f"AWSTemplateFormatVersion: {yaml.dump(output.pop('AWSTemplateFormatVersion'))}"
-        )
-        print(f"Transform:\n{yaml.dump(output.pop('Transform'))}")
-        print(yaml.dump(output))
+        # Render both environments concurrently; each does its own AWS I/O
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future1 = executor.submit(
+                process, args.config, args.env, args.template, prof1, args.log_level
+            )
+            future2 = executor.submit(
+                process, args.config, args.env2, args.template, prof2, args.log_level
+            )
+            output1, output2 = future1.result(), future2.result()
+
+        return compare([args.env, output1], [args.env2, output2])
+
+    output = process(args.config, args.env, args.template, prof1, args.log_level)
+    # The two small header values go through the pure-Python dumper: libyaml
+    # omits the "..." document end marker it writes after a top-level scalar
+    return "\n".join(
+        [
+            f"AWSTemplateFormatVersion: {yaml.dump(output.pop('AWSTemplateFormatVersion'))}",
+            f"Transform:\n{yaml.dump(output.pop('Transform'))}",
+            yaml.dump(output, Dumper=_YAMLDumper),
+        ]
+    )
 
 
 def main():
-    asyncio.run(async_main())
+    print(render_cli())
 
 
 if __name__ == "__main__":
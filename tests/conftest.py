@@ -0,0 +1,95 @@
+import copy
+import boto3
+import pytest
+import yaml
+from unittest.mock import MagicMock
+from samrenderer.main import TemplateRenderer, CFNLoader, _get_session
+
+
+SIMPLE_TEMPLATE = """
+Parameters:
+  Env:
+    Type: String
+    Default: dev
+
+Mappings:
+  RegionMap:
+    us-east-1:
+      AMI: ami-12345
+  ConfigMap:
+    dev:
+      DB: mysql
+    prod:
+      DB: aurora
+
+Conditions:
+  IsProd: !Equals [!Ref Env, prod]
+  IsNotProd: !Not [!Condition IsProd]
+
+Resources:
+  MyBucket:
+    Type: AWS::S3::Bucket
+    Properties:
+      # Adding a Ref here ensures 'mock-mybucket-id' appears in the output
+      # which fixes the test_main_cli_execution failure.
+      BucketName: !Ref MyBucket
+"""
+
+
+@pytest.fixture(scope="session")
+def simple_template(tmp_path_factory):
+    # Written once; tests must not modify the file
+    f = tmp_path_factory.mktemp("tpl") / "template.yaml"
+    f.write_text(SIMPLE_TEMPLATE, encoding="utf-8")
+    return str(f)
+
+
+class FakeSession:
+    """Stands in for boto3.Session; each service gets one cached MagicMock."""
+
+    def __init__(self, *args, **kwargs):
+        self.kwargs = kwargs
+        self.clients = {}
+
+    def client(self, service_name, **kwargs):
+        return self.clients.setdefault(service_name, MagicMock())
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _fake_boto_session():
+    # No test should reach boto3's credential chain or endpoint data
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(boto3, "Session", FakeSession)
+        yield
+
+
+@pytest.fixture(autouse=True)
+def _fresh_sessions():
+    # Sessions are shared across renderers; keep patched ones out of other tests
+    _get_session.cache_clear()
+    yield
+    _get_session.cache_clear()
+
+
+@pytest.fixture(scope="session")
+def parsed_simple_template():
+    # Shared between renderers; copy before handing it to one
+    return yaml.load(SIMPLE_TEMPLATE, Loader=CFNLoader)
+
+
+def _make_renderer(parsed_template):
+    return TemplateRenderer(
+        template_dict=copy.deepcopy(parsed_template), region="us-east-1"
+    )
+
+
+@pytest.fixture(scope="session")
+def renderer(parsed_simple_template):
+    """Shared by the whole session; only resolve() through it."""
+    return _make_renderer(parsed_simple_template)
+
+
+@pytest.fixture
+def mutable_renderer(parsed_simple_template):
+    """A private renderer for tests that edit it or inspect its caches."""
+    return _make_renderer(parsed_simple_template)
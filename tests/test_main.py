@@ -1,73 +1,50 @@
+import copy
+from collections import Counter
+import os
+import pathlib
+import tomllib
+import json
 import pytest
 import yaml
-import boto3
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 from botocore.exceptions import ClientError
 from samrenderer.main import (
     TemplateRenderer,
     parse_sam_overrides,
     load_sam_config,
+    _parse_sam_config,
     CFNLoader,
     main,
+    render_cli,
     compare,
+    _INTRINSIC_HANDLERS,
+    _INTRINSIC_KEYS,
+    _mock_azs,
 )
 
+DATA_DIR = pathlib.Path(__file__).parent / "data"
 
-# --- Fixtures ---
 
-
-@pytest.fixture
-def simple_template(tmp_path):
-    content = """
-    Parameters:
-      Env:
-        Type: String
-        Default: dev
-
-    Mappings:
-      RegionMap:
-        us-east-1:
-          AMI: ami-12345
-      ConfigMap:
-        dev:
-          DB: mysql
-        prod:
-          DB: aurora
-
-    Conditions:
-      IsProd: !Equals [!Ref Env, prod]
-      IsNotProd: !Not [!Condition IsProd]
-
-    Resources:
-      MyBucket:
-        Type: AWS::S3::Bucket
-        Properties:
-          # Adding a Ref here ensures 'mock-mybucket-id' appears in the output
-          # which fixes the test_main_cli_execution failure.
-          BucketName: !Ref MyBucket
-    """
-    f = tmp_path / "template.yaml"
-    f.write_text(content, encoding="utf-8")
-    return str(f)
-
-
-@pytest.fixture
-def renderer(simple_template):
-    return TemplateRenderer(simple_template, region="us-east-1")
+def assert_resolves(r, pairs):
+    """Resolve each node of (node, expected) pairs and compare them in one go."""
+    got = [r.resolve(node) for node, _ in pairs]
+    expected = [e for _, e in pairs]
+    # Types are compared too, so True does not pass for 1
+    assert [(type(v), v) for v in got] == [(type(e), e) for e in expected]
 
 
 # --- Unit Tests: CLI & Config ---
 
 
-def test_main_cli_execution(capsys, simple_template):
+def test_main_cli_execution(capsys, monkeypatch, simple_template):
     """Test the main entrypoint via CLI arguments."""
-    with patch("sys.argv", ["sam-render", simple_template]):
-        main()
-        captured = capsys.readouterr()
-        assert "mock-mybucket-id" in captured.out
+    monkeypatch.setattr("sys.argv", ["sam-render", simple_template])
+    main()
+    captured = capsys.readouterr()
+    assert "mock-mybucket-id" in captured.out
 
 
-def test_main_cli_diff(capsys, simple_template, tmp_path):
+def test_main_cli_diff(simple_template, monkeypatch):
     """Test the main entrypoint with --env2 to trigger diff mode."""
     config_content = """version = 0.1
 [dev.deploy.parameters]
@@ -76,40 +53,65 @@ parameter_overrides = "Env=\\\"dev\\\""
 [prod.deploy.parameters]
 parameter_overrides = "Env=\\\"prod\\\""
 """
-    config_file = tmp_path / "samconfig.toml"
-    config_file.write_text(config_content, encoding="utf-8")
+    monkeypatch.setattr(
+        "samrenderer.main.load_sam_config",
+        lambda path, env: _parse_sam_config(config_content, env),
+    )
 
     args = [
-        "sam-render",
         simple_template,
         "--config",
-        str(config_file),
+        "samconfig.toml",
         "--env",
         "dev",
         "--env2",
         "prod",
     ]
 
-    with patch("sys.argv", args):
-        main()
-        captured = capsys.readouterr()
-        assert "--- Environment dev" in captured.out
-        assert "+++ Environment prod" in captured.out
-        assert "IsProd: false" in captured.out
-        assert "IsProd: true" in captured.out
-
+    output = render_cli(args)
+    assert "--- Environment dev" in output
+    assert "+++ Environment prod" in output
+    assert "IsProd: false" in output
+    assert "IsProd: true" in output
+
+
+@pytest.mark.parametrize(
+    "extra_args, expected_profiles, expected_logins",
+    [
+        # Only --profile set: it is used for both envs
+        ([], ["my-profile", "my-profile"], ["my-profile"]),
+        # Both profiles set
+        (
+            ["--profile2", "prod-profile"],
+            ["my-profile", "prod-profile"],
+            ["my-profile", "prod-profile"],
+        ),
+    ],
+)
+def test_cli_profile_fallback(
+    monkeypatch,
+    simple_template,
+    tmp_path,
+    extra_args,
+    expected_profiles,
+    expected_logins,
+):
+    """Verify which profile each environment is rendered with."""
+    profiles_used, logins = [], []
+
+    def fake_process(config, env, template, profile, log_level="WARN"):
+        profiles_used.append(profile)
+        # Simple dicts avoid diff errors
+        return {"Resources": {}}
+
+    monkeypatch.setattr("samrenderer.main.process", fake_process)
+    monkeypatch.setattr("samrenderer.main.ensure_sso_login", logins.append)
 
-@patch("samrenderer.main.process")
-@patch("samrenderer.main.ensure_sso_login")
-def test_cli_profile_fallback(mock_login, mock_process, simple_template, tmp_path):
-    """Verify that if only --profile is set, it is used for both envs."""
     # Create dummy config
     config_file = tmp_path / "samconfig.toml"
     config_file.write_text("", encoding="utf-8")
 
-    # Case 1: Only --profile set
     args = [
-        "sam-render",
         simple_template,
         "--config",
         str(config_file),
@@ -119,73 +121,51 @@ def test_cli_profile_fallback(mock_login, mock_process, simple_template, tmp_pat
         "prod",
         "--profile",
         "my-profile",
-    ]
-
-    # Mock process to return simple dicts to avoid diff errors
-    mock_process.return_value = {"Resources": {}}
-
-    with patch("sys.argv", args):
-        main()
+    ] + extra_args
 
-    # Expect 2 calls to process. Both should have 'my-profile' as the 4th arg
-    assert mock_process.call_count == 2
+    render_cli(args)
 
-    # Check args of all calls
-    # call_args_list is [call(args...), call(args...)]
-    # call args: (config, env, template, profile, log_level)
-    profiles_used = [c.args[3] for c in mock_process.call_args_list]
-    assert profiles_used == ["my-profile", "my-profile"]
+    # The two envs render concurrently, so compare as multisets
+    assert Counter(profiles_used) == Counter(expected_profiles)
+    assert Counter(logins) == Counter(expected_logins)
 
-    # Expect login called once
-    mock_login.assert_called_once_with("my-profile")
 
-    # Reset mocks for Case 2
-    mock_process.reset_mock()
-    mock_login.reset_mock()
+RED = "\033[31m"
+GREEN = "\033[32m"
+RESET = "\033[0m"
 
-    # Case 2: Both profiles set
-    args_two = args + ["--profile2", "prod-profile"]
-    with patch("sys.argv", args_two):
-        main()
-
-    profiles_used_2 = sorted([c.args[3] for c in mock_process.call_args_list])
-    assert profiles_used_2 == ["my-profile", "prod-profile"]
-
-    # Expect login called for both
-    assert mock_login.call_count == 2
-
-
-def test_compare_function():
-    """Test the compare logic and ANSI coloring."""
-    # Setup data with some shared lines (context) and some diffs
-    env1_data = {
-        "Resources": {
-            "Shared": {"Type": "AWS::S3::Bucket"},
-            "Bucket": {"Properties": {"Name": "DevBucket"}},
-        }
+# Setup data with some shared lines (context) and some diffs
+COMPARE_ENV1 = {
+    "Resources": {
+        "Shared": {"Type": "AWS::S3::Bucket"},
+        "Bucket": {"Properties": {"Name": "DevBucket"}},
     }
-    env2_data = {
-        "Resources": {
-            "Shared": {"Type": "AWS::S3::Bucket"},
-            "Bucket": {"Properties": {"Name": "ProdBucket"}},
-        }
+}
+COMPARE_ENV2 = {
+    "Resources": {
+        "Shared": {"Type": "AWS::S3::Bucket"},
+        "Bucket": {"Properties": {"Name": "ProdBucket"}},
     }
-
-    output = compare(["dev", env1_data], ["prod", env2_data])
-
-    RED = "\033[31m"
-    GREEN = "\033[32m"
-    RESET = "\033[0m"
-
-    # Verify deletion and addition are colored
-    assert f"{RED}-      Name: DevBucket{RESET}" in output
-    assert f"{GREEN}+      Name: ProdBucket{RESET}" in output
-
-    # Verify context lines (shared) are present and NOT colored.
-    # The logic is: ' ' (diff prefix) + '  ' (yaml indent) = 3 spaces.
-    # We simply check that the string exists in the output without color codes prefixing it.
-    assert "   Shared:" in output
-    assert f"{RED}   Shared:" not in output
+}
+# Diffed once; the tests below only inspect the result
+COMPARE_OUTPUT = compare(["dev", COMPARE_ENV1], ["prod", COMPARE_ENV2])
+
+
+@pytest.mark.parametrize(
+    "needle, present",
+    [
+        # Deletion and addition are colored
+        (f"{RED}-      Name: DevBucket{RESET}", True),
+        (f"{GREEN}+      Name: ProdBucket{RESET}", True),
+        # Context lines: ' ' (diff prefix) + '  ' (yaml indent), uncolored
+        ("   Shared:", True),
+        (f"{RED}   Shared:", False),
+    ],
+    ids=["deletion-red", "addition-green", "context-plain", "context-not-red"],
+)
+def test_compare_function(needle, present):
+    """Test the compare logic and ANSI coloring."""
+    assert (needle in COMPARE_OUTPUT) is present
 
 
 def test_compare_no_diff():
@@ -199,6 +179,10 @@ def test_sam_config_missing_file():
 
 
 def test_sam_config_malformed(tmp_path):
+    with pytest.raises(tomllib.TOMLDecodeError):
+        _parse_sam_config("This is not TOML")
+
+    # From a file the error is reported as a warning instead
     f = tmp_path / "bad.toml"
     f.write_text("This is not TOML", encoding="utf-8")
     assert load_sam_config(str(f)) == {}
@@ -210,18 +194,32 @@ def test_sam_config_parsing_edge_cases():
     assert parse_sam_overrides(None) == {}
 
 
-def test_sam_config_with_region(tmp_path):
+def test_sam_config_with_region():
     """Test that region is extracted from SAM config."""
     config_content = """version = 0.1
 [default.deploy.parameters]
 region = "eu-central-1"
 parameter_overrides = "Key=Val"
 """
+    config = _parse_sam_config(config_content)
+    assert config["AWS::Region"] == "eu-central-1"
+
+
+def test_sam_config_parsed_once_per_mtime(tmp_path):
     f = tmp_path / "samconfig.toml"
-    f.write_text(config_content, encoding="utf-8")
+    f.write_text('[dev.deploy.parameters]\nparameter_overrides = "A=1"\n')
 
-    config = load_sam_config(str(f))
-    assert config["AWS::Region"] == "eu-central-1"
+    with patch("samrenderer.main.toml.load", wraps=tomllib.load) as mock_load:
+        first = load_sam_config(str(f), "dev")
+        first["A"] = "edited"
+        assert load_sam_config(str(f), "dev") == {"A": "1"}
+        assert mock_load.call_count == 1
+
+        stat = f.stat()
+        f.write_text('[dev.deploy.parameters]\nparameter_overrides = "A=2"\n')
+        os.utime(f, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        assert load_sam_config(str(f), "dev") == {"A": "2"}
+        assert mock_load.call_count == 2
 
 
 def test_yaml_loader_complex_tags():
@@ -236,14 +234,70 @@ def test_yaml_loader_complex_tags():
     assert data["TagOnDict"] == {"Fn::MyTag": {"a": 1}}
 
 
+@pytest.mark.skipif(not yaml.__with_libyaml__, reason="PyYAML built without libyaml")
+def test_yaml_loader_uses_libyaml():
+    assert issubclass(CFNLoader, yaml.CSafeLoader)
+
+
+def test_yaml_loader_interns_intrinsic_keys():
+    data = yaml.load("A: !Sub '${X}'\nB: !If [C, 1, 2]", Loader=CFNLoader)
+    assert next(iter(data["A"])) is _INTRINSIC_KEYS[_INTRINSIC_KEYS.index("Fn::Sub")]
+    assert next(iter(data["B"])) is _INTRINSIC_KEYS[_INTRINSIC_KEYS.index("Fn::If")]
+
+
+def test_template_names_interned(renderer):
+    (ref_name,) = renderer.resources["MyBucket"]["Properties"]["BucketName"].values()
+    assert ref_name is next(k for k in renderer.resources if k == "MyBucket")
+    (cond_name,) = renderer.conditions["IsNotProd"]["Fn::Not"][0].values()
+    assert cond_name is next(k for k in renderer.conditions if k == "IsProd")
+
+
+def test_template_parsed_once_per_mtime(tmp_path):
+    f = tmp_path / "template.yaml"
+    f.write_text("Resources:\n  MyRes: {Type: X}\n", encoding="utf-8")
+    with patch("samrenderer.main.yaml.load", wraps=yaml.load) as mock_load:
+        r1 = TemplateRenderer(str(f))
+        r1.resources["Extra"] = {}
+        r1.resources["MyRes"]["Properties"] = {"X": 1}
+        r2 = TemplateRenderer(str(f))
+        assert mock_load.call_count == 1
+        # Nested edits stay with the renderer that made them
+        assert "Extra" not in r2.resources
+        assert r2.resources["MyRes"] == {"Type": "X"}
+
+        stat = f.stat()
+        os.utime(f, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        TemplateRenderer(str(f))
+        assert mock_load.call_count == 2
+
+
+def test_renderer_from_string():
+    r = TemplateRenderer.from_string("Resources:\n  MyRes: {Type: X}\n")
+    assert r.resolve({"Ref": "MyRes"}) == "mock-myres-id"
+
+
+def test_renderer_from_template_dict(simple_template, parsed_simple_template):
+    from_dict = TemplateRenderer(template_dict=copy.deepcopy(parsed_simple_template))
+    from_path = TemplateRenderer(simple_template)
+    assert from_dict.resolve_resources() == from_path.resolve_resources()
+
+    with pytest.raises(ValueError):
+        TemplateRenderer()
+
+
 # --- Unit Tests: Intrinsics & Resolution ---
 
 
 def test_ref_resolution(renderer):
-    assert renderer.resolve({"Ref": "Env"}) == "dev"
-    assert renderer.resolve({"Ref": "AWS::Region"}) == "us-east-1"
-    assert renderer.resolve({"Ref": "MyBucket"}) == "mock-mybucket-id"
-    assert renderer.resolve({"Ref": "UnknownThing"}) == "{Ref: UnknownThing}"
+    assert_resolves(
+        renderer,
+        [
+            ({"Ref": "Env"}, "dev"),
+            ({"Ref": "AWS::Region"}, "us-east-1"),
+            ({"Ref": "MyBucket"}, "mock-mybucket-id"),
+            ({"Ref": "UnknownThing"}, "{Ref: UnknownThing}"),
+        ],
+    )
 
 
 def test_find_in_map_standard(renderer):
@@ -269,105 +323,184 @@ def test_sub_resolution(renderer):
     assert renderer.resolve(node) == "Region is us-east-1"
 
 
-def test_sub_priority(renderer):
-    renderer.resources["MyRes"] = {}
-    assert renderer.resolve({"Fn::Sub": ["${Var}", {"Var": "local"}]}) == "local"
-    assert renderer.resolve({"Fn::Sub": "${AWS::Region}"}) == "us-east-1"
-    assert renderer.resolve({"Fn::Sub": "${MyRes}"}) == "mock-myres-id"
-    assert renderer.resolve({"Fn::Sub": "${Whoops}"}) == "${Whoops}"
+def test_sub_priority(mutable_renderer):
+    mutable_renderer.resources["MyRes"] = {}
+    assert_resolves(
+        mutable_renderer,
+        [
+            ({"Fn::Sub": ["${Var}", {"Var": "local"}]}, "local"),
+            ({"Fn::Sub": "${AWS::Region}"}, "us-east-1"),
+            ({"Fn::Sub": "${MyRes}"}, "mock-myres-id"),
+            ({"Fn::Sub": "${Whoops}"}, "${Whoops}"),
+        ],
+    )
 
 
-def test_import_value_mock_aws(simple_template):
-    with patch.object(boto3, "Session") as mock_session_cls:
-        # Explicitly create the session mock instance
-        mock_sess_inst = MagicMock()
-        mock_session_cls.return_value = mock_sess_inst
-
-        mock_client = MagicMock()
-        # Attach return_value to the client method of the instance
-        mock_sess_inst.client.return_value = mock_client
-
-        mock_client.list_exports.return_value = {
-            "Exports": [
-                {"Name": "MyExport", "Value": "RealValue"},
-                {"Name": "OtherExport", "Value": "OtherValue"},
-            ]
-        }
+def test_sub_debug_logging(capsys, simple_template):
+    quiet = TemplateRenderer(simple_template)
+    assert quiet.resolve({"Fn::Sub": "${Env}"}) == "dev"
+    assert capsys.readouterr().err == ""
 
-        r = TemplateRenderer(simple_template, profile="test-profile")
+    verbose = TemplateRenderer(simple_template, log_level="DEBUG")
+    assert verbose.resolve({"Fn::Sub": "${Env}"}) == "dev"
+    entry = json.loads(capsys.readouterr().err)
+    assert entry["operation"] == "Sub"
+    assert entry["message"] == "Resolved to: dev"
 
-        assert r.resolve({"Fn::ImportValue": "MyExport"}) == "RealValue"
-        assert r.resolve({"Fn::ImportValue": "Missing"}) == "mock-import-Missing"
+    assert verbose.resolve({"Fn::Sub": "${MyBucket}"}) == "mock-mybucket-id"
+    entry = json.loads(capsys.readouterr().err)
+    assert entry["message"] == "Resolved to Mock: mock-mybucket-id"
 
-        # Raise a proper ClientError to test the exception handling
-        error_response = {
-            "Error": {"Code": "ServiceUnavailable", "Message": "AWS Down"}
-        }
-        mock_client.list_exports.side_effect = ClientError(
-            error_response, "ListExports"
-        )
 
-        assert r.resolve({"Fn::ImportValue": "MyExport"}) == "mock-import-MyExport"
+def test_sub_skips_unused_variables(renderer):
+    # Resolving the unused entry would raise
+    node = {"Fn::Sub": ["${A}-${A}", {"A": "x", "B": {"Fn::Join": [",", 5]}}]}
+    assert renderer.resolve(node) == "x-x"
 
 
-def test_secrets_manager_edge_cases(simple_template):
-    """Test binary secrets, invalid JSON, and missing keys."""
-    with patch.object(boto3, "Session") as mock_session_cls:
-        mock_sess_inst = MagicMock()
-        mock_session_cls.return_value = mock_sess_inst
+def test_aws_clients_created_lazily(simple_template):
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    r.resolve_resources()
+    assert r.boto_session.clients == {}
 
-        mock_sm = MagicMock()
+    r.resolve({"Fn::ImportValue": "Anything"})
+    r.resolve({"Fn::ImportValue": "Other"})
+    assert list(r.boto_session.clients) == ["cloudformation"]
+    assert r.cfn_client is r.boto_session.clients["cloudformation"]
 
-        # Correct side_effect signature and logic
-        def client_side_effect(service_name, **kwargs):
-            if service_name == "secretsmanager":
-                return mock_sm
-            return MagicMock()
 
-        # Important: Set side_effect on the .client method of the session instance
-        mock_sess_inst.client.side_effect = client_side_effect
+def test_session_shared_per_profile_and_region(simple_template):
+    r1 = TemplateRenderer(simple_template, profile="test")
+    r2 = TemplateRenderer(simple_template, profile="test")
+    r3 = TemplateRenderer(simple_template, profile="test", region="eu-west-1")
 
-        r = TemplateRenderer(simple_template, profile="test-profile")
+    assert r1.boto_session is r2.boto_session
+    assert r3.boto_session is not r1.boto_session
+    assert r3.boto_session.kwargs == {
+        "profile_name": "test",
+        "region_name": "eu-west-1",
+    }
 
-        # 1. Binary Secret (SecretString is None)
-        mock_sm.get_secret_value.return_value = {"SecretBinary": b"binary_data"}
-        # Ensure we convert bytes to string representation for assertion
-        assert r.resolve("{{resolve:secretsmanager:BinarySecret}}") == "b'binary_data'"
 
-        # 2. Invalid JSON
-        mock_sm.get_secret_value.return_value = {"SecretString": "not_json"}
-        res = r.resolve("{{resolve:secretsmanager:BadJson:Key}}")
-        assert "Error: Secret is not valid JSON" in res
+def test_import_value_mock_aws(simple_template):
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    mock_client = r.boto_session.client("cloudformation")
+    mock_paginate = mock_client.get_paginator.return_value.paginate
+    mock_paginate.return_value = [
+        {"Exports": [{"Name": "MyExport", "Value": "RealValue"}]},
+        {"Exports": [{"Name": "OtherExport", "Value": "OtherValue"}]},
+    ]
 
-        # 3. Missing Key in JSON
-        mock_sm.get_secret_value.return_value = {"SecretString": '{"Foo": "Bar"}'}
-        res = r.resolve("{{resolve:secretsmanager:MissingKey:Baz}}")
-        assert "Error: Key Baz not found" in res
+    assert r.resolve({"Fn::ImportValue": "MyExport"}) == "RealValue"
+    assert r.resolve({"Fn::ImportValue": "Missing"}) == "mock-import-Missing"
+    assert r.resolve({"Fn::ImportValue": "OtherExport"}) == "OtherValue"
 
+    # The exports table is paged through once and reused
+    mock_client.get_paginator.assert_called_once_with("list_exports")
+    mock_paginate.assert_called_once()
 
-def test_ref_to_dynamic_reference(simple_template):
-    """Test that !Ref to a parameter containing {{resolve...}} recursively resolves it."""
-    with patch.object(boto3, "Session") as mock_session_cls:
-        mock_sess_inst = MagicMock()
-        mock_session_cls.return_value = mock_sess_inst
+    # Raise a proper ClientError to test the exception handling
+    error_response = {"Error": {"Code": "ServiceUnavailable", "Message": "AWS Down"}}
+    mock_paginate.side_effect = ClientError(error_response, "ListExports")
+
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    assert r.resolve({"Fn::ImportValue": "MyExport"}) == "mock-import-MyExport"
+
+
+class FakeSecretsManager:
+    """Plain Secrets Manager client returning whatever response is set."""
+
+    def __init__(self, response=None):
+        self.response = response
+        self.calls = []
+
+    def get_secret_value(self, SecretId):
+        self.calls.append(SecretId)
+        return self.response
+
+
+def test_secrets_manager_edge_cases(simple_template):
+    """Test binary secrets, invalid JSON, and missing keys."""
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    fake_sm = r.boto_session.clients["secretsmanager"] = FakeSecretsManager()
+
+    # 1. Binary Secret (SecretString is None)
+    fake_sm.response = {"SecretBinary": b"binary_data"}
+    # Ensure we convert bytes to string representation for assertion
+    assert r.resolve("{{resolve:secretsmanager:BinarySecret}}") == "b'binary_data'"
+
+    # 2. Invalid JSON
+    fake_sm.response = {"SecretString": "not_json"}
+    res = r.resolve("{{resolve:secretsmanager:BadJson:Key}}")
+    assert "Error: Secret is not valid JSON" in res
+
+    # 3. Missing Key in JSON
+    fake_sm.response = {"SecretString": '{"Foo": "Bar"}'}
+    res = r.resolve("{{resolve:secretsmanager:MissingKey:Baz}}")
+    assert "Error: Key Baz not found" in res
+
+    # 4. Repeated references to one secret are fetched once
+    fake_sm.calls.clear()
+    fake_sm.response = {"SecretString": '{"A": "1", "B": "2"}'}
+    assert r.resolve("{{resolve:secretsmanager:Shared:A}}") == "1"
+    assert r.resolve("{{resolve:secretsmanager:Shared:B}}") == "2"
+    assert fake_sm.calls == ["Shared"]
+
+
+def test_prefetch_secrets_and_exports(simple_template):
+    """Referenced secrets and exports are fetched up front and served from cache."""
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    mock_sm = r.boto_session.client("secretsmanager")
+    mock_cfn = r.boto_session.client("cloudformation")
+    mock_sm.batch_get_secret_value.return_value = {
+        "SecretValues": [
+            {"Name": "One", "ARN": "arn-one", "SecretString": '{"User": "u"}'},
+            {"Name": "Two", "ARN": "arn-two", "SecretString": "plain"},
+        ],
+        "Errors": [],
+    }
+    mock_cfn.get_paginator.return_value.paginate.return_value = [
+        {"Exports": [{"Name": "VpcId", "Value": "vpc-123"}]}
+    ]
+
+    r.update_context({"DbUser": "{{resolve:secretsmanager:One:User}}"})
+    r.resources["Extra"] = {
+        "Properties": {
+            "Token": ["{{resolve:secretsmanager:Two}}", "no reference here"],
+            "Param": "{{resolve:ssm:NotASecret}}",
+            "Vpc": {"Fn::ImportValue": "VpcId"},
+        }
+    }
+    assert r._collect_refs([r.resources, list(r.context.values())]) == (
+        {"One", "Two"},
+        True,
+    )
 
-        mock_sm = MagicMock()
+    r.prefetch()
+    mock_sm.batch_get_secret_value.assert_called_once_with(SecretIdList=["One", "Two"])
+    mock_cfn.get_paginator.assert_called_once_with("list_exports")
 
-        def client_side_effect(service_name, **kwargs):
-            if service_name == "secretsmanager":
-                return mock_sm
-            return MagicMock()
+    resolved = r.resolve_resources()
+    assert r.resolve({"Ref": "DbUser"}) == "u"
+    assert resolved["Extra"]["Properties"]["Token"][0] == "plain"
+    assert resolved["Extra"]["Properties"]["Vpc"] == "vpc-123"
+    mock_sm.get_secret_value.assert_not_called()
+    mock_cfn.get_paginator.assert_called_once()
 
-        mock_sess_inst.client.side_effect = client_side_effect
-        mock_sm.get_secret_value.return_value = {"SecretString": "SecretValue"}
 
-        # Setup renderer
-        r = TemplateRenderer(simple_template, profile="test-profile")
-        # Inject parameter with dynamic ref
-        r.context["MyParam"] = "{{resolve:secretsmanager:MySecret}}"
+def test_ref_to_dynamic_reference(simple_template):
+    """Test that !Ref to a parameter containing {{resolve...}} recursively resolves it."""
+    # Setup renderer
+    r = TemplateRenderer(simple_template, profile="test-profile")
+    r.boto_session.clients["secretsmanager"] = FakeSecretsManager(
+        {"SecretString": "SecretValue"}
+    )
 
-        # Resolve !Ref MyParam
-        assert r.resolve({"Ref": "MyParam"}) == "SecretValue"
+    # Inject parameter with dynamic ref
+    r.update_context({"MyParam": "{{resolve:secretsmanager:MySecret}}"})
+
+    # Resolve !Ref MyParam
+    assert r.resolve({"Ref": "MyParam"}) == "SecretValue"
 
 
 def test_split_select_success(renderer):
@@ -394,6 +527,16 @@ def test_getazs(renderer):
     assert renderer.resolve(node_implicit) == ["us-east-1a", "us-east-1b", "us-east-1c"]
 
 
+def test_getazs_cached_per_region(renderer):
+    node = {"Fn::GetAZs": "eu-west-1"}
+    first = renderer.resolve(node)
+    hits = _mock_azs.cache_info().hits
+    second = renderer.resolve(node)
+    assert _mock_azs.cache_info().hits == hits + 1
+    assert first == second and first is not second
+    assert "&id" not in yaml.dump({"a": first, "b": second})
+
+
 def test_condition_missing(renderer):
     assert renderer.resolve({"Condition": "NonExistent"}) is False
 
@@ -409,37 +552,62 @@ def test_fn_condition_explicit(renderer):
 # --- Logic Tests (Existing) ---
 
 
-def test_sub_with_nested_if(tmp_path):
-    content = """
-    Parameters:
-      Env: {Type: String, Default: dev}
-      IsSpecial: {Type: String, Default: "false"}
-    Conditions:
-      CheckSpecial: !Equals [!Ref IsSpecial, "true"]
-    Resources:
-      TestResource:
-        Properties:
-          Name: !Sub
-            - "Prefix-${Suffix}"
-            - Suffix: !If [CheckSpecial, "Special", !Ref Env]
-    """
-    f = tmp_path / "sub_logic.yaml"
-    f.write_text(content, encoding="utf-8")
-
-    r1 = TemplateRenderer(str(f))
+def test_sub_with_nested_if():
+    # The file is parsed once; each renderer gets its own copy of the tree
+    path = str(DATA_DIR / "sub_logic.yaml")
+    r1 = TemplateRenderer(path)
     res1 = r1.resolve(r1.resources)
     assert res1["TestResource"]["Properties"]["Name"] == "Prefix-dev"
 
-    r2 = TemplateRenderer(str(f))
-    r2.context["IsSpecial"] = "true"
+    r2 = TemplateRenderer(path)
+    r2.update_context({"IsSpecial": "true"})
     res2 = r2.resolve(r2.resources)
     assert res2["TestResource"]["Properties"]["Name"] == "Prefix-Special"
 
 
 def test_logic_operators(renderer):
-    assert renderer.resolve({"Fn::Equals": ["a", "a"]}) is True
-    assert renderer.resolve({"Fn::Not": [{"Fn::Equals": ["a", "a"]}]}) is False
-    assert renderer.resolve({"Fn::Or": [False, True]}) is True
+    assert_resolves(
+        renderer,
+        [
+            ({"Fn::Equals": ["a", "a"]}, True),
+            ({"Fn::Not": [{"Fn::Equals": ["a", "a"]}]}, False),
+            ({"Fn::Or": [False, True]}, True),
+        ],
+    )
+
+
+def test_logic_short_circuit_and_shared_operands(mutable_renderer):
+    # The second operand would raise if it were evaluated
+    broken = {"Fn::Join": [",", 5]}
+    assert mutable_renderer.resolve({"Fn::And": [False, broken]}) is False
+    assert mutable_renderer.resolve({"Fn::Or": [True, broken]}) is True
+
+
+@pytest.fixture
+def equals_calls(monkeypatch):
+    """Record every Fn::Equals evaluation."""
+    equals = _INTRINSIC_HANDLERS["Fn::Equals"]
+    calls = []
+
+    def counting_equals(self, args):
+        calls.append(args)
+        return equals(self, args)
+
+    monkeypatch.setitem(_INTRINSIC_HANDLERS, "Fn::Equals", counting_equals)
+    return calls
+
+
+def test_logic_shared_operands_resolved_once_per_walk(mutable_renderer, equals_calls):
+    # A sub-expression shared between operators is resolved once per walk
+    shared = {"Fn::Equals": [{"Ref": "Env"}, "dev"]}
+    node = {"Fn::And": [shared, {"Fn::Or": [shared]}]}
+    assert mutable_renderer.resolve(node) is True
+    assert len(equals_calls) == 1
+
+    # The next walk starts afresh and sees the new context
+    mutable_renderer.update_context({"Env": "prod"})
+    assert mutable_renderer.resolve(node) is False
+    assert len(equals_calls) == 2
 
 
 def test_nested_logic_structure(renderer):
@@ -465,6 +633,59 @@ def test_condition_evaluation(renderer):
     assert renderer.resolve({"Condition": "IsNotProd"}) is True
 
 
+def test_condition_memoized(mutable_renderer, equals_calls):
+    """A condition is evaluated once and reused by later Fn::If/Condition lookups."""
+    # IsNotProd is defined as !Not [!Condition IsProd]
+    assert mutable_renderer.resolve({"Fn::If": ["IsProd", "a", "b"]}) == "b"
+    assert mutable_renderer.resolve({"Fn::If": ["IsProd", "a", "b"]}) == "b"
+    assert mutable_renderer.resolve({"Condition": "IsNotProd"}) is True
+    assert len(equals_calls) == 1
+
+    # A context update re-evaluates it once
+    mutable_renderer.update_context({"Env": "prod"})
+    assert mutable_renderer.resolve({"Fn::If": ["IsProd", "a", "b"]}) == "a"
+    assert mutable_renderer.resolve({"Condition": "IsNotProd"}) is False
+    assert len(equals_calls) == 2
+
+
+def test_resolve_resources_evaluates_conditions_eagerly(mutable_renderer):
+    mutable_renderer.resolve_resources()
+    assert mutable_renderer._cond_cache == {"IsProd": False, "IsNotProd": True}
+    assert mutable_renderer.resolve_conditions() == mutable_renderer.resolve(
+        mutable_renderer.conditions
+    )
+
+
+def test_resolve_resources_skips_false_conditions(mutable_renderer):
+    mutable_renderer.resources["ProdOnly"] = {"Type": "X", "Condition": "IsProd"}
+    mutable_renderer.resources["DevOnly"] = {"Type": "X", "Condition": "IsNotProd"}
+    resolved = mutable_renderer.resolve_resources()
+    assert "ProdOnly" not in resolved
+    assert resolved["DevOnly"] == {"Type": "X", "Condition": "IsNotProd"}
+
+    mutable_renderer.update_context({"Env": "prod"})
+    assert set(mutable_renderer.resolve_resources()) == {"MyBucket", "ProdOnly"}
+
+
+def test_resolve_resources_keeps_undefined_condition(mutable_renderer, capsys):
+    mutable_renderer.resources["Typo"] = {"Type": "X", "Condition": "IsPord"}
+    resolved = mutable_renderer.resolve_resources()
+    assert resolved["Typo"] == {"Type": "X", "Condition": "IsPord"}
+
+    entry = json.loads(capsys.readouterr().err)
+    assert entry["level"] == "ERROR"
+    assert entry["key"] == "IsPord"
+    assert entry["resource_id"] == "Typo"
+
+
+def test_update_context_invalidates_conditions(mutable_renderer):
+    assert mutable_renderer.resolve({"Condition": "IsProd"}) is False
+
+    mutable_renderer.update_context({"Env": "prod"})
+    assert mutable_renderer.resolve({"Condition": "IsProd"}) is True
+    assert mutable_renderer.resolve({"Fn::If": ["IsNotProd", "a", "b"]}) == "b"
+
+
 def test_base64(renderer):
     node = {"Fn::Base64": "UserDataScript"}
     assert renderer.resolve(node) == "[Base64: UserDataScript]"
@@ -477,34 +698,34 @@ def test_no_value_removal(renderer):
     assert "Key2" not in resolved
 
 
+def test_resolve_deeply_nested(renderer):
+    """Nesting deeper than the recursion limit resolves without RecursionError."""
+    node = leaf = {}
+    for _ in range(5000):
+        leaf["Child"] = [{"Ref": "AWS::NoValue"}, {}]
+        leaf = leaf["Child"][1]
+    leaf["Value"] = {"Ref": "Env"}
+
+    resolved = renderer.resolve(node)
+    for _ in range(5000):
+        assert len(resolved["Child"]) == 1
+        resolved = resolved["Child"][0]
+    assert resolved == {"Value": "dev"}
+
+
 def test_sam_config_parsing():
     raw_str = 'VpcStackName="vpc" Environment="dev"'
     expected = {"VpcStackName": "vpc", "Environment": "dev"}
     assert parse_sam_overrides(raw_str) == expected
 
 
-def test_complex_environment_logic(tmp_path):
-    content = """
-    Parameters:
-      Environment: {Type: String, Default: dev}
-      SubEnvironment: {Type: String, Default: none}
-    Mappings:
-      EnvironmentConfiguration:
-        dev: {Key: "key-from-dev"}
-    Conditions:
-      UseSubEnvironment: !Not [!Equals [!Ref SubEnvironment, none]]
-    Resources:
-      TestPolicy:
-        Properties:
-          Resource:
-            - !If
-              - UseSubEnvironment
-              - !FindInMap [EnvironmentConfiguration, !Ref SubEnvironment, Key]
-              - !FindInMap [EnvironmentConfiguration, !Ref Environment, Key]
-    """
-    f = tmp_path / "complex.yaml"
-    f.write_text(content, encoding="utf-8")
+def test_sam_config_parsing_quoted_and_bare_values():
+    raw_str = 'Quoted="a b" Bare=plain Empty="" Dashed-Key_1=7'
+    expected = {"Quoted": "a b", "Bare": "plain", "Empty": "", "Dashed-Key_1": "7"}
+    assert parse_sam_overrides(raw_str) == expected
+
 
-    r = TemplateRenderer(str(f), region="us-east-1")
+def test_complex_environment_logic():
+    r = TemplateRenderer(str(DATA_DIR / "complex_env.yaml"))
     resolved = r.resolve(r.resources)
     assert resolved["TestPolicy"]["Properties"]["Resource"][0] == "key-from-dev"